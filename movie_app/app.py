@@ -1,25 +1,38 @@
 # app.py
+from functools import wraps
 from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, abort
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField, IntegerField, SubmitField
 from wtforms.validators import DataRequired, Length, EqualTo, NumberRange
 from flask_restful import Api
-from models import db, User, Movie, Review
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer, joinedload
+from models import db, User, Movie, Review, user_favorites
 from config import Config
+from json_provider import JSONProvider, output_json
+from cache import (cache, GENRES_KEY, HOME_MOVIES_KEY, ADMIN_STATS_KEY,
+                   invalidate_movie_cache, invalidate_review_cache, invalidate_favorite_cache)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'dev-secret-key-123'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///movies.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config.from_object(Config)
+app.json = JSONProvider(app)
 
 # Инициализация
 db.init_app(app)
+cache.init_app(app)
 api = Api(app, prefix='/api/v1')
+api.representations['application/json'] = output_json
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# Скомпилированные шаблоны сохраняются между перезапусками процесса
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
 
 # Формы для веб-части
 class LoginForm(FlaskForm):
@@ -53,7 +66,19 @@ class ReviewForm(FlaskForm):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+
+def admin_required(view):
+    """Доступ к маршруту только для администраторов"""
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        # current_user загружается один раз за запрос и хранится Flask-Login на g
+        if not current_user.is_admin:
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
 
 
 # Веб-маршруты
@@ -61,24 +86,63 @@ def load_user(user_id):
 def index():
     # Главная страница
     # Показываем топ фильмов и новые фильмы
-    top_movies = Movie.query.order_by(Movie.rating.desc()).limit(6).all()
-    new_movies = Movie.query.order_by(Movie.created_at.desc()).limit(6).all()
+    top_movies, new_movies = get_home_movies()
 
     # Только для админов показываем статистику
     movie_count = user_count = review_count = None
     if current_user.is_authenticated and current_user.is_admin:
-        movie_count = Movie.query.count()
-        user_count = User.query.count()
-        review_count = Review.query.count()
+        movie_count, user_count, review_count = get_admin_stats()
 
     return render_template('index.html',
                            top_movies=top_movies,
                            new_movies=new_movies,
+                           favorite_ids=card_favorite_ids(top_movies + new_movies),
                            movie_count=movie_count,
                            user_count=user_count,
                            review_count=review_count)
 
 
+@cache.cached(timeout=60, key_prefix=HOME_MOVIES_KEY)
+def get_home_movies():
+    # Топ по рейтингу и новинки одним запросом: UNION ALL двух выборок id
+    # с номером раздела, затем фильмы по этим id
+    top = db.select(Movie.id, db.literal(0).label('section')) \
+        .order_by(Movie.rating.desc()).limit(6).subquery()
+    new = db.select(Movie.id, db.literal(1).label('section')) \
+        .order_by(Movie.created_at.desc()).limit(6).subquery()
+    sections = db.union_all(db.select(top), db.select(new)).subquery()
+    rows = db.session.execute(
+        db.select(Movie, sections.c.section)
+        .join(sections, sections.c.id == Movie.id)
+        .options(defer(Movie.description))
+    ).all()
+    top_movies = sorted((movie for movie, section in rows if section == 0),
+                        key=lambda movie: movie.rating, reverse=True)
+    new_movies = sorted((movie for movie, section in rows if section == 1),
+                        key=lambda movie: movie.created_at, reverse=True)
+    return top_movies, new_movies
+
+
+def card_favorite_ids(movies):
+    # Избранное текущего пользователя среди карточек страницы одним запросом,
+    # чтобы звездочка на карточке и добавляла, и удаляла фильм.
+    # Не кэшируется: список фильмов главной общий для всех пользователей
+    if not current_user.is_authenticated:
+        return set()
+    return current_user.favorite_ids([movie.id for movie in movies])
+
+
+@cache.cached(timeout=60, key_prefix=ADMIN_STATS_KEY)
+def get_admin_stats():
+    # Три COUNT(*) одним запросом вместо трех
+    counts = db.select(
+        db.select(db.func.count()).select_from(Movie).scalar_subquery(),
+        db.select(db.func.count()).select_from(User).scalar_subquery(),
+        db.select(db.func.count()).select_from(Review).scalar_subquery(),
+    )
+    return tuple(db.session.execute(counts).one())
+
+
 @app.route('/movies')
 def movie_list():
     # Список всех фильмов
@@ -86,30 +150,46 @@ def movie_list():
     genre_filter = request.args.get('genre')
     search_query = request.args.get('search')
 
-    query = Movie.query
+    # Карточки фильмов не показывают описание - не тянем его из базы
+    query = Movie.query.options(defer(Movie.description))
 
-    if genre_filter:
-        query = query.filter(Movie.genre.ilike(f'%{genre_filter}%'))
-
-    if search_query:
-        query = query.filter(Movie.title.ilike(f'%{search_query}%'))
+    if genre_filter or search_query:
+        query = query.filter(Movie.search_clause(title=search_query, genre=genre_filter))
 
     movies = query.order_by(Movie.title).paginate(page=page, per_page=12)
 
-    # Получаем все жанры для фильтра
-    genres = db.session.query(Movie.genre).distinct().all()
-    genre_list = [g[0] for g in genres if g[0]]
+    return render_template('movie_list.html', movies=movies, genres=get_genres(),
+                           favorite_ids=card_favorite_ids(movies.items),
+                           review_counts=Movie.review_counts([m.id for m in movies.items]))
+
 
-    return render_template('movie_list.html', movies=movies, genres=genre_list)
+@cache.cached(key_prefix=GENRES_KEY)
+def get_genres():
+    # Список отдельных жанров для фильтра (в поле genre они через запятую);
+    # сбрасывается при изменении фильмов
+    genres = db.session.scalars(db.select(Movie.genre).distinct())
+    return sorted({name.strip() for value in genres if value
+                   for name in value.split(',') if name.strip()})
 
 
 @app.route('/movie/<int:movie_id>', methods=['GET', 'POST'])
 def movie_detail(movie_id):
-    # Страница фильма - доступна ВСЕМ пользователям
-    movie = Movie.query.get_or_404(movie_id)
-
-    # Отзывы видят ВСЕ
-    reviews = Review.query.filter_by(movie_id=movie_id).order_by(Review.created_at.desc()).all()
+    # Страница фильма - доступна ВСЕМ пользователям.
+    # Признак "в избранном" приходит вместе с фильмом
+    row = Movie.get_with_favorites(movie_id, current_user)
+    if row is None:
+        abort(404)
+    movie, is_favorite = row
+
+    # Отзывы видят ВСЕ; авторов подгружаем тем же запросом, чтобы шаблон
+    # не делал отдельный SELECT на каждый review.user.
+    # Номер страницы отзывов за пределами списка не дает 404 всей странице фильма
+    reviews = (Review.query
+               .options(joinedload(Review.user))
+               .filter_by(movie_id=movie_id)
+               .order_by(Review.created_at.desc())
+               .paginate(page=request.args.get('rpage', 1, type=int), per_page=20,
+                         error_out=False))
 
     form = ReviewForm()
 
@@ -126,54 +206,54 @@ def movie_detail(movie_id):
             movie_id=movie_id
         )
         db.session.add(review)
-        movie.update_rating()
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            flash('Вы уже оставляли отзыв на этот фильм', 'warning')
+            return redirect(url_for('movie_detail', movie_id=movie_id))
+        Movie.change_rating(movie_id, review.rating, 1)
         db.session.commit()
+        invalidate_review_cache(movie_id)
         flash('Отзыв добавлен!', 'success')
         return redirect(url_for('movie_detail', movie_id=movie_id))
 
-    # Проверяем избранное (только для авторизованных)
-    is_favorite = False
-    if current_user.is_authenticated:
-        if hasattr(current_user, 'is_favorite'):
-            try:
-                is_favorite = current_user.is_favorite(movie)
-            except:
-                is_favorite = False
-
     return render_template('movie_detail.html',
                            movie=movie,
                            reviews=reviews,
                            form=form,
-                           is_favorite=is_favorite)
+                           is_favorite=bool(is_favorite))
 
 
 @app.route('/movie/<int:movie_id>/favorite', methods=['POST'])
 @login_required
 def toggle_favorite(movie_id):
     # Добавить/удалить фильм из избранного
-    movie = Movie.query.get_or_404(movie_id)
+    # Кнопки шаблонов передают action=add|remove, поэтому текущее состояние читать не нужно
+    title = db.session.execute(db.select(Movie.title).where(Movie.id == movie_id)).scalar()
+    if title is None:
+        abort(404)
 
-    # Безопасная проверка
+    action = request.form.get('action')
     try:
-        # Проверяем, добавлен ли уже фильм в избранное
-        is_currently_favorite = current_user.is_favorite(movie) if hasattr(current_user, 'is_favorite') else False
+        if action not in ('add', 'remove'):
+            action = 'remove' if current_user.is_favorite(movie_id) else 'add'
 
-        if is_currently_favorite:
-            current_user.remove_favorite(movie)
-            action = "удален из"
-            new_status = False
+        # add_favorite/remove_favorite возвращают None, если избранное не изменилось
+        if action == 'remove':
+            changed = current_user.remove_favorite(movie_id) is not None
+            message = "удален из" if changed else "не в"
         else:
-            current_user.add_favorite(movie)
-            action = "добавлен в"
-            new_status = True
+            changed = current_user.add_favorite(movie_id) is not None
+            message = "добавлен в" if changed else "уже в"
 
-        db.session.commit()
-        flash(f'Фильм "{movie.title}" {action} избранное', 'success')
+        if changed:
+            db.session.commit()
+            invalidate_favorite_cache(movie_id)
+            flash(f'Фильм "{title}" {message} избранное', 'success')
+        else:
+            flash(f'Фильм "{title}" {message} избранном', 'info')
 
-    except AttributeError as e:
-        # Если у пользователя нет метода is_favorite
-        flash('Ошибка: функция избранного недоступна. Пожалуйста, перезайдите в систему.', 'danger')
-        return redirect(url_for('login'))
     except Exception as e:
         db.session.rollback()
         flash(f'Ошибка при добавлении в избранное: {str(e)}', 'danger')
@@ -186,18 +266,20 @@ def toggle_favorite(movie_id):
 def favorites():
     # Страница избранных фильмов
     page = request.args.get('page', 1, type=int)
-    favorite_movies = current_user.favorite_movies.paginate(page=page, per_page=12)
+    favorite_movies = (Movie.query
+                       .options(defer(Movie.description))
+                       .join(user_favorites)
+                       .filter(user_favorites.c.user_id == current_user.id)
+                       .paginate(page=page, per_page=12))
 
-    return render_template('favorites.html', favorite_movies=favorite_movies)
+    return render_template('favorites.html', favorite_movies=favorite_movies,
+                           review_counts=Movie.review_counts([m.id for m in favorite_movies.items]))
 
 
 @app.route('/movie/add', methods=['GET', 'POST'])
-@login_required
+@admin_required
 def add_movie():
     # Добавление фильма
-    if not current_user.is_admin:
-        abort(403)
-
     form = MovieForm()
     if form.validate_on_submit():
         movie = Movie(
@@ -209,6 +291,7 @@ def add_movie():
         )
         db.session.add(movie)
         db.session.commit()
+        invalidate_movie_cache(movie.id)
         flash('Фильм добавлен!', 'success')
         return redirect(url_for('movie_detail', movie_id=movie.id))
 
@@ -216,12 +299,9 @@ def add_movie():
 
 
 @app.route('/movie/<int:movie_id>/edit', methods=['GET', 'POST'])
-@login_required
+@admin_required
 def edit_movie(movie_id):
     # Редактирование фильма
-    if not current_user.is_admin:
-        abort(403)
-
     movie = Movie.query.get_or_404(movie_id)
     form = MovieForm(obj=movie)
 
@@ -233,6 +313,7 @@ def edit_movie(movie_id):
         movie.genre = form.genre.data
 
         db.session.commit()
+        invalidate_movie_cache(movie.id)
         flash('Фильм обновлен!', 'success')
         return redirect(url_for('movie_detail', movie_id=movie.id))
 
@@ -240,15 +321,13 @@ def edit_movie(movie_id):
 
 
 @app.route('/movie/<int:movie_id>/delete', methods=['POST'])
-@login_required
+@admin_required
 def delete_movie(movie_id):
     # Удаление фильма
-    if not current_user.is_admin:
-        abort(403)
-
     movie = Movie.query.get_or_404(movie_id)
     db.session.delete(movie)
     db.session.commit()
+    invalidate_movie_cache(movie_id)
     flash('Фильм удален!', 'success')
     return redirect(url_for('movie_list'))
 
@@ -263,6 +342,8 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user and user.check_password(form.password.data):
+            # Сохраняем хэш, если check_password пересчитал его
+            db.session.commit()
             login_user(user)
             flash('Вы успешно вошли!', 'success')
             return redirect(url_for('index'))
@@ -279,9 +360,11 @@ def register():
 
     form = RegisterForm()
     if form.validate_on_submit():
-        # Проверяем, существует ли пользователь
-        existing_user = User.query.filter_by(username=form.username.data).first()
-        if existing_user:
+        # Проверяем, существует ли пользователь (EXISTS по уникальному индексу, без загрузки строки)
+        username_taken = db.session.query(
+            db.exists().where(User.username == form.username.data)
+        ).scalar()
+        if username_taken:
             flash('Это имя пользователя уже занято', 'danger')
             return redirect(url_for('register'))
 
@@ -289,6 +372,7 @@ def register():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
+        cache.delete(ADMIN_STATS_KEY)
         flash('Регистрация успешна! Теперь вы можете войти.', 'success')
         return redirect(url_for('login'))
 
@@ -309,7 +393,7 @@ def logout():
 def profile():
     # Профиль пользователя
     reviews = Review.query.filter_by(user_id=current_user.id).order_by(Review.created_at.desc()).limit(10).all()
-    favorite_count = current_user.favorite_movies.count()
+    favorite_count = current_user.favorite_count()
 
     return render_template('profile.html',
                            reviews=reviews,
@@ -317,51 +401,44 @@ def profile():
 
 
 @app.route('/reinit-db')
-@login_required
+@admin_required
 def reinit_db_route():
     # Пересоздание базы данных (только админ)
-    if not current_user.is_admin:
-        abort(403)
-
-    # Удаляем все таблицы и создаем заново
-    db.drop_all()
-    db.create_all()
-
-    # Инициализируем заново
-    from init_db import init_db
-    init_db(app)
-
-    flash('База данных успешно пересоздана!', 'success')
+    # Удаление и заполнение таблиц идет в фоне, запрос сразу возвращается
+    from init_db import reinit_db_in_background
+    if reinit_db_in_background(app):
+        flash('Пересоздание базы данных запущено. Обновите страницу через несколько секунд.', 'info')
+    else:
+        flash('База данных уже пересоздается', 'warning')
     return redirect(url_for('index'))
 
 
 @app.route('/admin/users')
-@login_required
+@admin_required
 def admin_users():
     # Страница управления пользователями (только для админов)
-    if not current_user.is_admin:
-        abort(403)
-
     # Получаем всех пользователей
     users = User.query.order_by(User.created_at.desc()).all()
 
-    # Статистика
-    admin_count = User.query.filter_by(is_admin=True).count()
-    regular_count = User.query.filter_by(is_admin=False).count()
+    # Статистика считается по уже загруженному списку, без отдельных COUNT
+    admin_count = sum(1 for user in users if user.is_admin)
+    regular_count = len(users) - admin_count
+
+    # Счетчики отзывов и избранного - по запросу на всю таблицу, а не на каждого
+    user_ids = [user.id for user in users]
 
     return render_template('admin/users.html',
                            users=users,
                            admin_count=admin_count,
-                           regular_count=regular_count)
+                           regular_count=regular_count,
+                           review_counts=User.review_counts(user_ids),
+                           favorite_counts=User.favorite_counts(user_ids))
 
 
 @app.route('/admin/user/<int:user_id>/make_admin', methods=['POST'])
-@login_required
+@admin_required
 def make_admin(user_id):
     # Сделать пользователя администратором
-    if not current_user.is_admin:
-        abort(403)
-
     user = User.query.get_or_404(user_id)
 
     # Нельзя изменить свой статус
@@ -377,12 +454,9 @@ def make_admin(user_id):
 
 
 @app.route('/admin/user/<int:user_id>/remove_admin', methods=['POST'])
-@login_required
+@admin_required
 def remove_admin(user_id):
     # Убрать права администратора
-    if not current_user.is_admin:
-        abort(403)
-
     user = User.query.get_or_404(user_id)
 
     # Нельзя изменить свой статус
@@ -397,14 +471,15 @@ def remove_admin(user_id):
     return redirect(url_for('admin_users'))
 
 
+# REST API регистрируется при импорте модуля: он нужен и под gunicorn (app:app), и в тестах
+from rest_api import register_api_resources
+
+register_api_resources(api)
+
+
 if __name__ == '__main__':
     from init_db import init_db
 
     init_db(app)
 
-    # Импортируем REST API после создания приложения
-    from rest_api import register_api_resources
-
-    register_api_resources(api)
-
-    app.run(host='127.0.0.1', port=8080, debug=True)
\ No newline at end of file
+    app.run(host='127.0.0.1', port=8080, debug=app.config['DEBUG'])
\ No newline at end of file
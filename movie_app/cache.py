@@ -0,0 +1,37 @@
+# cache.py
+from flask_caching import Cache
+
+cache = Cache()
+
+# Ключи кэша, зависящие от данных фильмов
+GENRES_KEY = 'movie_genres'
+# Топ и новинки главной страницы
+HOME_MOVIES_KEY = 'home_movies'
+ADMIN_STATS_KEY = 'admin_stats'
+# Ответы API без полей текущего пользователя (is_favorite)
+MOVIE_LIST_KEY = 'api_movie_list'
+
+
+def movie_key(movie_id):
+    """Ключ кэша для данных одного фильма в API"""
+    return f'movie:{movie_id}'
+
+
+def _movie_keys(movie_id):
+    return [MOVIE_LIST_KEY] + ([movie_key(movie_id)] if movie_id is not None else [])
+
+
+def invalidate_movie_cache(movie_id=None):
+    """Сброс закэшированных данных после изменения фильмов"""
+    cache.delete_many(GENRES_KEY, HOME_MOVIES_KEY, ADMIN_STATS_KEY,
+                      *_movie_keys(movie_id))
+
+
+def invalidate_review_cache(movie_id=None):
+    """Сброс данных, зависящих от отзывов (рейтинг и статистика)"""
+    cache.delete_many(HOME_MOVIES_KEY, ADMIN_STATS_KEY, *_movie_keys(movie_id))
+
+
+def invalidate_favorite_cache(movie_id):
+    """Сброс данных API, содержащих счетчик избранного"""
+    cache.delete_many(*_movie_keys(movie_id))
@@ -1,8 +1,37 @@
 import os
+from sqlalchemy.engine import make_url
+
+
+def engine_options(database_uri):
+    """Параметры пула соединений SQLAlchemy для заданной БД"""
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # SQLite в памяти работает через одно общее соединение (StaticPool)
+        return {}
+    options = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    }
+    if url.get_backend_name() == 'sqlite':
+        # Файл не "отваливается" как сетевое соединение: ping и recycle не нужны.
+        # Запись ждет освобождения блокировки до 30 с вместо ошибки database is locked
+        options['connect_args'] = {'timeout': 30}
+    else:
+        options.update(pool_pre_ping=True, pool_recycle=1800)
+    return options
 
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///movies.db'
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    DEBUG = True
+    # Явная стоимость хэширования: время входа не меняется вместе с версией Werkzeug.
+    # Старые хэши пересчитываются при следующем входе пользователя
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    # SimpleCache живет в памяти процесса; для нескольких воркеров - RedisCache
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'SimpleCache'
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    CACHE_DEFAULT_TIMEOUT = 300
+    # Режим отладки (и перезагрузка шаблонов) только по FLASK_DEBUG=1
+    DEBUG = os.environ.get('FLASK_DEBUG') == '1'
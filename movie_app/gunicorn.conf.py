@@ -0,0 +1,44 @@
+# gunicorn.conf.py
+# Запуск в продакшене: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8080')
+
+# SimpleCache (по умолчанию в config.py) живет в памяти воркера: сброс кэша
+# после записи очистил бы только один процесс, остальные отдавали бы старые
+# данные. Несколько воркеров - только с общим кэшем (CACHE_TYPE=RedisCache)
+CACHE_TYPE = os.environ.get('CACHE_TYPE') or 'SimpleCache'
+PROCESS_LOCAL_CACHE = CACHE_TYPE.rsplit('.', 1)[-1] in ('SimpleCache', 'simple')
+
+workers = int(os.environ.get('GUNICORN_WORKERS',
+                             1 if PROCESS_LOCAL_CACHE else multiprocessing.cpu_count() * 2 + 1))
+
+# gevent-воркер сам выполняет monkey.patch_all() до загрузки приложения,
+# поэтому в app.py патчить ничего не нужно
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1024))
+
+# Greenlet'ов в воркере много - пул соединений с БД должен быть больше обычного
+raw_env = [
+    f"DB_POOL_SIZE={os.environ.get('DB_POOL_SIZE', 20)}",
+    f"DB_MAX_OVERFLOW={os.environ.get('DB_MAX_OVERFLOW', 40)}",
+]
+
+
+def on_starting(server):
+    # Проверяем итоговое число воркеров - его можно задать и ключом -w
+    if PROCESS_LOCAL_CACHE and server.cfg.workers > 1:
+        raise RuntimeError(
+            f'{CACHE_TYPE} не общий для процессов: при {server.cfg.workers} воркерах '
+            'нужен CACHE_TYPE=RedisCache и REDIS_URL'
+        )
+
+
+def post_fork(server, worker):
+    # psycopg2 (PostgreSQL) не отдает управление другим greenlet'ам без psycogreen
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    patch_psycopg()
@@ -1,168 +1,141 @@
 # init_db.py
-from models import db, User, Movie, Review
+import json
+import os
+import threading
+
+from sqlalchemy.schema import CreateColumn
+
+from models import db, User, Movie, Review, create_movie_search
+from cache import cache
+
+# Не даем запустить два пересоздания базы одновременно
+_reinit_lock = threading.Lock()
+
+SEED_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed.json')
+
+
+def _load_seed():
+    """Тестовые данные: {'movies': [...], 'reviews': [...]}"""
+    with open(SEED_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _add_missing_columns():
+    """Добавляет в существующие таблицы колонки, появившиеся в моделях позже.
+
+    create_all создает только отсутствующие таблицы; возвращает множество
+    добавленных колонок вида 'таблица.колонка'.
+    """
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    added = set()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}')
+                added.add(f'{table.name}.{column.name}')
+    return added
 
 
 def init_db(app):
     """Инициализация базы данных"""
     with app.app_context():
         db.create_all()
+        added_columns = _add_missing_columns()
+        if 'movie.favorite_count' in added_columns:
+            Movie.update_all_favorite_counts()
+            db.session.commit()
+        if {'movie.rating_sum', 'movie.rating_count'} & added_columns:
+            Movie.update_all_ratings()
+            db.session.commit()
+        # create_all не добавляет новые индексы в уже существующие таблицы
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        # То же для поискового индекса: в старой базе его может не быть
+        if db.engine.dialect.name == 'sqlite' and not db.inspect(db.engine).has_table('movie_fts'):
+            with db.engine.begin() as connection:
+                create_movie_search(connection)
+        if db.engine.dialect.name == 'sqlite':
+            # Обновляет статистику планировщика для индексов, где она устарела
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('PRAGMA optimize')
         # Создаем тестовые данные если база пустая
         if Movie.query.count() == 0:
-            # Создаем админа
-            admin = User(username='admin', email='admin@example.com', is_admin=True)
-            admin.set_password('admin123')
-            db.session.add(admin)
-
-            # Создаем обычного пользователя
-            user = User(username='user', email='user@example.com')
-            user.set_password('user123')
-            db.session.add(user)
-
-            # Добавляем БОЛЬШЕ крутых фильмов!
-            movies = [
-                Movie(title='Интерстеллар', year=2014, director='Кристофер Нолан',
-                      genre='Фантастика, Драма',
-                      description='Фантастический эпос о космических путешествиях, поиске нового дома для человечества и силе любви.'),
-
-                Movie(title='Крестный отец', year=1972, director='Фрэнсис Форд Коппола',
-                      genre='Криминал, Драма',
-                      description='Эпическая история мафиозной семьи Корлеоне в послевоенной Америке.'),
-
-                Movie(title='Побег из Шоушенка', year=1994, director='Фрэнк Дарабонт',
-                      genre='Драма',
-                      description='История о надежде и свободе в тюрьме строгого режима.'),
-
-                Movie(title='Начало', year=2010, director='Кристофер Нолан',
-                      genre='Фантастика, Боевик',
-                      description='Талантливый вор, промышляющий в мире снов, получает задание не украсть, а внедрить идею.'),
-
-                Movie(title='Темный рыцарь', year=2008, director='Кристофер Нолан',
-                      genre='Боевик, Криминал',
-                      description='Бэтмен, комиссар Гордон и прокурор Харви Дент ведут войну с криминалом в Готэме.'),
-
-                Movie(title='Форрест Гамп', year=1994, director='Роберт Земекис',
-                      genre='Драма, Мелодрама',
-                      description='История простого человека, ставшего свидетелем ключевых событий американской истории.'),
-
-                Movie(title='Список Шиндлера', year=1993, director='Стивен Спилберг',
-                      genre='Драма, Биография',
-                      description='Немецкий предприниматель Оскар Шиндлер спасает более тысячи евреев во время Холокоста.'),
-
-                Movie(title='Властелин колец: Возвращение короля', year=2003, director='Питер Джексон',
-                      genre='Фэнтези, Приключения',
-                      description='Завершение эпической трилогии о борьбе за Кольцо Всевластия.'),
-
-                Movie(title='Бойцовский клуб', year=1999, director='Дэвид Финчер',
-                      genre='Драма, Триллер',
-                      description='История офисного работника, который встречает загадочного торговца мылом и создает подпольный бойцовский клуб.'),
-
-                Movie(title='Джентльмены', year=2019, director='Гай Ричи',
-                      genre='Криминал, Комедия',
-                      description='Американский наркобарон пытается продать свой бизнес лондонскому олигарху.'),
-
-                Movie(title='Дюна', year=2021, director='Дени Вильнёв',
-                      genre='Фантастика, Драма',
-                      description='Пол Атрейдес отправляется на опасную планету Арракис, чтобы защитить будущее своей семьи и народа.'),
-
-                Movie(title='Оппенгеймер', year=2023, director='Кристофер Нолан',
-                      genre='Драма, Биография',
-                      description='История создания атомной бомбы и моральная дилемма ее создателя.'),
-
-                Movie(title='Аватар', year=2009, director='Джеймс Кэмерон',
-                      genre='Фантастика, Приключения',
-                      description='Парализованный морпех становится частью программы по освоению планеты Пандора.'),
-
-                Movie(title='Джокер', year=2019, director='Тодд Филлипс',
-                      genre='Драма, Криминал',
-                      description='История превращения неудачливого комика в психопата-преступника.'),
-
-                Movie(title='Брат', year=1997, director='Алексей Балабанов',
-                      genre='Криминал, Драма',
-                      description='Демобилизованный солдат Данила Багров становится наемным убийцей в Петербурге.'),
-
-                Movie(title='Легенда №17', year=2013, director='Николай Лебедев',
-                      genre='Драма, Спорт',
-                      description='История хоккеиста Валерия Харламова и легендарной суперсерии СССР-Канада 1972 года.'),
-
-                Movie(title='Движение вверх', year=2017, director='Антон Мегердичев',
-                      genre='Драма, Спорт',
-                      description='История победы сборной СССР по баскетболу над американцами на Олимпиаде-1972.'),
-
-                Movie(title='Игра престолов (сериал)', year=2011, director='Дэвид Бениофф, Д.Б. Уайсс',
-                      genre='Фэнтези, Драма',
-                      description='Борьба за Железный Трон в вымышленном мире Вестероса.'),
-
-                Movie(title='Во все тяжкие (сериал)', year=2008, director='Винс Гиллиган',
-                      genre='Криминал, Драма',
-                      description='Школьный учитель химии становится наркобароном после того, как узнает, что болен раком.'),
-
-                Movie(title='Иван Васильевич меняет профессию', year=1973, director='Леонид Гайдай',
-                      genre='Комедия, Фантастика',
-                      description='Изобретатель Шурик создает машину времени и случайно отправляет управдома в прошлое.'),
-
-                Movie(title='Один дома', year=1990, director='Крис Коламбус',
-                      genre='Комедия, Семейный',
-                      description='8-летний Кевин остался один дома и защищает свой дом от грабителей.'),
-
-                Movie(title='Унесенные призраками', year=2001, director='Хаяо Миядзаки',
-                      genre='Аниме, Фэнтези',
-                      description='Девочка Тихиро попадает в мир духов и пытается спасти своих родителей.'),
-
-                Movie(title='Твоё имя', year=2016, director='Макото Синкай',
-                      genre='Аниме, Мелодрама',
-                      description='Парень и девушка из разных городов обнаруживают, что меняются телами во сне.'),
-
-                Movie(title='Матрица', year=1999, director='Братья Вачовски',
-                      genre='Фантастика, Боевик',
-                      description='Хакер по имени Нео узнает, что мир, в котором он живет - это компьютерная симуляция.'),
+            seed_data()
+            db.session.commit()
 
-                Movie(title='Бегущий по лезвию 2049', year=2017, director='Дени Вильнёв',
-                      genre='Фантастика, Драма',
-                      description='Охотник на андроидов раскрывает секрет, способный разрушить общество.'),
 
-                Movie(title='Сияние', year=1980, director='Стэнли Кубрик',
-                      genre='Ужасы, Драма',
-                      description='Писатель с семьей поселяется в отеле, где на него воздействуют злые силы.'),
+def seed_data():
+    """Заполнение пустых таблиц тестовыми данными в текущей сессии (без commit).
 
-                Movie(title='Оно', year=2017, director='Андрес Мускетти',
-                      genre='Ужасы',
-                      description='Группа детей из городка Дерри сталкивается со злобным клоуном Пеннивайзом.'),
+    Вызывается внутри контекста приложения; фиксирует изменения вызывающий.
+    """
+    # Создаем админа
+    admin = User(username='admin', email='admin@example.com', is_admin=True)
+    admin.set_password('admin123')
+    db.session.add(admin)
 
-                Movie(title='Зеленая книга', year=2018, director='Питер Фаррелли',
-                      genre='Драма, Комедия',
-                      description='Путешествие афроамериканского пианиста и его итальянского водителя по югу США в 1960-х.'),
+    # Создаем обычного пользователя
+    user = User(username='user', email='user@example.com')
+    user.set_password('user123')
+    db.session.add(user)
 
-                Movie(title='1+1', year=2011, director='Оливье Накаш',
-                      genre='Драма, Комедия',
-                      description='Парализованный аристократ нанимает в сиделки бывшего заключенного.')
-            ]
+    # Тестовые фильмы и отзывы лежат в seed.json и читаются только при заполнении базы
+    seed = _load_seed()
 
-            for movie in movies:
-                db.session.add(movie)
+    # Фильмы и отзывы вставляются пакетно (executemany)
+    db.session.execute(db.insert(Movie), seed['movies'])
+    movie_ids = db.session.scalars(db.select(Movie.id).order_by(Movie.id)).all()
 
-            db.session.commit()
+    # Добавляем тестовые отзывы: авторы чередуются, по отзыву на первые фильмы
+    db.session.flush()  # id пользователей
+    authors = [admin.id, user.id]
+    db.session.execute(db.insert(Review), [
+        dict(review, user_id=authors[i % len(authors)], movie_id=movie_ids[i])
+        for i, review in enumerate(seed['reviews'])
+    ])
 
-            # Добавляем тестовые отзывы
-            reviews = [
-                Review(content='Невероятное кино! Графика и сюжет на высоте.', rating=5, user_id=1, movie_id=1),
-                Review(content='Классика, которую должен посмотреть каждый.', rating=5, user_id=2, movie_id=2),
-                Review(content='Трогательная история о надежде.', rating=5, user_id=1, movie_id=3),
-                Review(content='Гениальный сюжет, Кристофер Нолан - гений!', rating=5, user_id=2, movie_id=4),
-                Review(content='Лучший фильм про Бэтмена, Хит Леджер великолепен!', rating=5, user_id=1, movie_id=5),
-                Review(content='Потрясающая актерская игра Тома Хэнкса.', rating=4, user_id=2, movie_id=6),
-                Review(content='Тяжелый, но важный фильм о войне.', rating=5, user_id=1, movie_id=7),
-                Review(content='Эпическое завершение трилогии.', rating=5, user_id=2, movie_id=8),
-                Review(content='Культовый фильм Тарантино.', rating=4, user_id=1, movie_id=9),
-                Review(content='Фильм, который меняет мировоззрение.', rating=5, user_id=2, movie_id=10)
-            ]
-
-            for review in reviews:
-                db.session.add(review)
+    # Рейтинги всех фильмов - одним UPDATE
+    Movie.update_all_ratings()
 
-            db.session.commit()
 
-            # Обновляем рейтинги фильмов
-            for movie in Movie.query.all():
-                movie.update_rating()
+def reinit_db(app):
+    """Очистка всех таблиц и повторное заполнение тестовыми данными.
 
-            db.session.commit()
\ No newline at end of file
+    Удаление, заполнение и commit идут в одной сессии и одной транзакции:
+    пока она не завершена, остальные запросы (SQLite в режиме WAL) видят
+    прежние данные. Возвращает False, если пересоздать базу не удалось.
+    """
+    with app.app_context():
+        try:
+            for table in reversed(db.metadata.sorted_tables):
+                db.session.execute(table.delete())
+            seed_data()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Не удалось пересоздать базу данных')
+            return False
+        # Меняются все фильмы - сбрасываем кэш целиком
+        cache.clear()
+    return True
+
+
+def reinit_db_in_background(app):
+    """Пересоздание базы данных в фоновом потоке. False - если оно уже идет"""
+    if not _reinit_lock.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            reinit_db(app)
+        finally:
+            _reinit_lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
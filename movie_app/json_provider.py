@@ -0,0 +1,41 @@
+# json_provider.py
+from flask import make_response
+from flask.json.provider import DefaultJSONProvider
+from flask_restful.representations.json import output_json as restful_output_json
+
+try:
+    import orjson
+except ImportError:  # orjson собирается только под CPython (под PyPy его нет)
+    orjson = None
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON через orjson: быстрее стандартного json и без лишних пробелов"""
+
+    def _dumpb(self, obj):
+        # Неподдерживаемые orjson типы (Decimal, __html__) обрабатывает стандартный default
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps(self, obj, **kwargs):
+        return self._dumpb(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify() отдает байты orjson напрямую, без промежуточной str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumpb(obj), mimetype=self.mimetype)
+
+
+def orjson_output(data, code, headers=None):
+    """Представление application/json для Flask-RESTful"""
+    resp = make_response(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), code)
+    resp.headers['Content-Type'] = 'application/json'
+    resp.headers.extend(headers or {})
+    return resp
+
+
+# Без orjson остаются стандартные сериализаторы Flask и Flask-RESTful
+JSONProvider = ORJSONProvider if orjson else DefaultJSONProvider
+output_json = orjson_output if orjson else restful_output_json
@@ -1,15 +1,72 @@
+import re
+import sqlite3
+from functools import lru_cache
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читать базу во время записи; остальное - кэш и mmap в памяти
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 МБ кэша страниц на соединение
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+
+# INSERT ... ON CONFLICT DO NOTHING для СУБД, которые его поддерживают
+_INSERT_IGNORE = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+}
+
+
+def _password_hash_method():
+    # Метод и стоимость хэширования паролей задаются в конфиге (см. Config)
+    return current_app.config.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+
+@lru_cache
+def _password_hash_prefix(method):
+    # Короткая запись метода ('scrypt', 'pbkdf2') в хэше раскрывается в полную
+    # ('scrypt:32768:8:1'), поэтому префикс берем из настоящего хэша - один раз на метод
+    return generate_password_hash('', method).partition('$')[0] + '$'
+
+
+def _run_blocking(func, *args):
+    # Под gevent хэширование (десятки мс CPU) уходит в настоящий поток из пула хаба:
+    # hashlib отпускает GIL, и остальные greenlet'ы воркера продолжают работать.
+    # Без gevent вызываем напрямую - поток запроса и так свой
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args)
+    if not monkey.is_module_patched('threading'):
+        return func(*args)
+    return get_hub().threadpool.apply(func, args)
+
+
 # Таблица для связи многие-ко-многим (избранные фильмы)
 user_favorites = db.Table('user_favorites',
                           db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
                           db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
-                          db.Column('added_at', db.DateTime, default=datetime.utcnow)
+                          db.Column('added_at', db.DateTime, default=datetime.utcnow),
+                          # Первичный ключ начинается с user_id; поиск "кто добавил фильм"
+                          # (пересчет счетчиков, удаление фильма) идет по этому индексу
+                          db.Index('ix_user_favorites_movie_user', 'movie_id', 'user_id')
                           )
 
 
@@ -26,50 +83,105 @@ class User(UserMixin, db.Model):
     # Связь с избранными фильмами
     favorite_movies = db.relationship('Movie',
                                       secondary=user_favorites,
-                                      backref=db.backref('favorited_by', lazy='dynamic'),
-                                      lazy='dynamic')
+                                      backref=db.backref('favorited_by', lazy='write_only', passive_deletes=True))
 
     # Отношения
-    reviews = db.relationship('Review', backref='user', lazy='dynamic', cascade='all, delete-orphan')
+    reviews = db.relationship('Review', backref='user', lazy='write_only', cascade='all, delete-orphan')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _run_blocking(generate_password_hash, password, _password_hash_method())
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-
-    def add_favorite(self, movie):
-        if not self.is_favorite(movie):
-            self.favorite_movies.append(movie)
-            return True
-        return False
-
-    def remove_favorite(self, movie):
-        if self.is_favorite(movie):
-            self.favorite_movies.remove(movie)
-            return True
-        return False
-
-    def is_favorite(self, movie):
-        return self.favorite_movies.filter(
-            user_favorites.c.movie_id == movie.id
-        ).count() > 0
-
-    def to_dict(self):
+        if not _run_blocking(check_password_hash, self.password_hash, password):
+            return False
+        # Хэш со старыми параметрами пересчитываем под текущий PASSWORD_HASH_METHOD
+        if not self.password_hash.startswith(_password_hash_prefix(_password_hash_method())):
+            self.set_password(password)
+        return True
+
+    # Избранное меняем напрямую в таблице связи, не загружая коллекцию favorite_movies;
+    # счетчик Movie.favorite_count меняется только если строка связи действительно изменилась.
+    # Оба метода возвращают новый favorite_count фильма или None, если ничего не изменилось
+    def add_favorite(self, movie_id):
+        # INSERT ... SELECT: строка связи появляется только для существующего фильма
+        source = db.select(db.literal(self.id), Movie.id).where(Movie.id == movie_id)
+        insert = _INSERT_IGNORE.get(db.session.get_bind().dialect.name)
+        if insert is not None:
+            stmt = insert(user_favorites).from_select(['user_id', 'movie_id'], source) \
+                .on_conflict_do_nothing()
+        elif self.is_favorite(movie_id):
+            return None
+        else:
+            stmt = user_favorites.insert().from_select(['user_id', 'movie_id'], source)
+        if db.session.execute(stmt).rowcount != 1:
+            return None
+        return Movie.change_favorite_count(movie_id, 1)
+
+    def remove_favorite(self, movie_id):
+        result = db.session.execute(user_favorites.delete().where(
+            user_favorites.c.user_id == self.id,
+            user_favorites.c.movie_id == movie_id
+        ))
+        if result.rowcount != 1:
+            return None
+        return Movie.change_favorite_count(movie_id, -1)
+
+    def is_favorite(self, movie_id):
+        # EXISTS останавливается на первой найденной строке первичного ключа
+        return db.session.query(db.exists().where(
+            user_favorites.c.user_id == self.id,
+            user_favorites.c.movie_id == movie_id
+        )).scalar()
+
+    def favorite_ids(self, movie_ids=None):
+        """Множество id избранных фильмов (при необходимости - только среди movie_ids)"""
+        query = db.select(user_favorites.c.movie_id).where(user_favorites.c.user_id == self.id)
+        if movie_ids is not None:
+            query = query.where(user_favorites.c.movie_id.in_(movie_ids))
+        return set(db.session.scalars(query))
+
+    def favorite_count(self):
+        return db.session.query(db.func.count()).select_from(user_favorites).filter(
+            user_favorites.c.user_id == self.id
+        ).scalar()
+
+    @staticmethod
+    def favorite_counts(user_ids):
+        """Число избранных фильмов для набора пользователей одним запросом: {user_id: count}"""
+        if not user_ids:
+            return {}
+        return dict(db.session.execute(
+            db.select(user_favorites.c.user_id, db.func.count())
+            .where(user_favorites.c.user_id.in_(user_ids))
+            .group_by(user_favorites.c.user_id)
+        ).all())
+
+    @staticmethod
+    def review_counts(user_ids):
+        """Число отзывов для набора пользователей одним запросом: {user_id: count}"""
+        if not user_ids:
+            return {}
+        return dict(db.session.execute(
+            db.select(Review.user_id, db.func.count())
+            .where(Review.user_id.in_(user_ids))
+            .group_by(Review.user_id)
+        ).all())
+
+    def to_dict(self, favorite_count=None):
         return {
             'id': self.id,
             'username': self.username,
             'email': self.email,
             'is_admin': self.is_admin,
             'created_at': self.created_at.isoformat(),
-            'favorite_count': self.favorite_movies.count()
+            'favorite_count': self.favorite_count() if favorite_count is None else favorite_count
         }
 
-    reviews = db.relationship('Review', backref='user', lazy='dynamic', cascade='all, delete-orphan')
-    favorite_movies = db.relationship('Movie',
-                                      secondary=user_favorites,
-                                      backref=db.backref('favorited_by', lazy='dynamic'),
-                                      lazy='dynamic')
+    @classmethod
+    def to_dict_list(cls, users):
+        """Сериализация списка пользователей без COUNT на каждого"""
+        favorite_counts = cls.favorite_counts([user.id for user in users])
+        return [user.to_dict(favorite_counts.get(user.id, 0)) for user in users]
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -83,32 +195,149 @@ class Movie(db.Model):
     year = db.Column(db.Integer, nullable=False, index=True)
     director = db.Column(db.String(100))
     description = db.Column(db.Text)
-    genre = db.Column(db.String(100))
+    genre = db.Column(db.String(100), index=True)
     rating = db.Column(db.Float, default=0.0)
+    # Сумма и число оценок для пересчета рейтинга без чтения отзывов (см. change_rating)
+    rating_sum = db.Column(db.Integer, default=0, server_default=db.text('0'), nullable=False)
+    rating_count = db.Column(db.Integer, default=0, server_default=db.text('0'), nullable=False)
+    # Денормализованный счетчик избранного (см. User.add_favorite/remove_favorite)
+    favorite_count = db.Column(db.Integer, default=0, server_default=db.text('0'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Отношения
-    reviews = db.relationship('Review', backref='movie', lazy='dynamic', cascade='all, delete-orphan')
-
-    def update_rating(self):
-        if self.reviews.count() > 0:
-            from sqlalchemy import func
-            avg_rating = db.session.query(func.avg(Review.rating)).filter(
-                Review.movie_id == self.id
-            ).scalar()
-            self.rating = round(float(avg_rating or 0), 1)
+    # write_only: коллекции никогда не грузятся целиком, счетчики хранятся в колонках;
+    # при удалении фильма отзывы и избранное удаляются одним DELETE (см. _delete_movie_dependents)
+    reviews = db.relationship('Review', backref='movie', lazy='write_only',
+                              cascade='all, delete-orphan', passive_deletes=True)
+
+    # Индексы под ORDER BY ... LIMIT на главной странице
+    __table_args__ = (
+        db.Index('ix_movie_rating_desc', rating.desc()),
+        db.Index('ix_movie_created_desc', created_at.desc()),
+    )
+
+    @staticmethod
+    def _average(rating_sum, rating_count):
+        # Средняя оценка с одним знаком; без отзывов рейтинг 0
+        return db.case((rating_count > 0, db.func.round(rating_sum * 1.0 / rating_count, 1)),
+                       else_=0.0)
+
+    @staticmethod
+    def change_rating(movie_id, rating, count_delta):
+        """Добавляет (count_delta=1) или убирает (-1) оценку из рейтинга фильма.
+
+        Сумма и число оценок хранятся в фильме, поэтому рейтинг пересчитывается
+        одним UPDATE без чтения отзывов. Возвращает название фильма (тем же
+        запросом через RETURNING, где СУБД это умеет) или None, если фильма нет.
+        """
+        rating_sum = Movie.rating_sum + rating * count_delta
+        rating_count = Movie.rating_count + count_delta
+        stmt = db.update(Movie).where(Movie.id == movie_id).values(
+            rating_sum=rating_sum,
+            rating_count=rating_count,
+            rating=Movie._average(rating_sum, rating_count),
+        )
+        if not db.session.get_bind().dialect.update_returning:
+            if db.session.execute(stmt).rowcount != 1:
+                return None
+            return db.session.scalar(db.select(Movie.title).where(Movie.id == movie_id))
+        return db.session.execute(stmt.returning(Movie.title)).scalar()
+
+    @staticmethod
+    def update_all_ratings():
+        """Пересчет суммы, числа оценок и рейтинга всех фильмов по отзывам.
+
+        Отзывы агрегируются одним проходом GROUP BY и применяются через
+        UPDATE ... FROM; фильмы без отзывов предварительно обнуляются.
+        """
+        totals = db.select(Review.movie_id,
+                           db.func.sum(Review.rating).label('rating_sum'),
+                           db.func.count().label('rating_count')) \
+            .group_by(Review.movie_id).subquery()
+        db.session.execute(db.update(Movie).values(rating_sum=0, rating_count=0, rating=0.0))
+        db.session.execute(db.update(Movie).where(Movie.id == totals.c.movie_id).values(
+            rating_sum=totals.c.rating_sum,
+            rating_count=totals.c.rating_count,
+            rating=Movie._average(totals.c.rating_sum, totals.c.rating_count),
+        ))
+
+    @classmethod
+    def search_clause(cls, title=None, genre=None):
+        """Условие поиска по названию и жанру.
+
+        В SQLite ищет по полнотекстовому индексу movie_fts (слова названия
+        ищутся по префиксу, жанр - как фраза), в остальных СУБД - через ILIKE.
+        """
+        title_words = _fts_words(title)
+        genre_words = _fts_words(genre)
+        if db.session.get_bind().dialect.name != 'sqlite' or \
+                (title and not title_words) or (genre and not genre_words):
+            conditions = []
+            if title:
+                conditions.append(cls.title.ilike(f'%{title}%'))
+            if genre:
+                conditions.append(cls.genre.ilike(f'%{genre}%'))
+            return db.and_(*conditions)
+
+        terms = []
+        if title_words:
+            terms.append('title : (' + ' '.join(f'"{w}"*' for w in title_words) + ')')
+        if genre_words:
+            terms.append('genre : "' + ' '.join(genre_words) + '"')
+        match = db.select(db.literal_column('rowid')).select_from(db.table('movie_fts')).where(
+            db.text('movie_fts MATCH :match').bindparams(match=' AND '.join(terms))
+        )
+        return cls.id.in_(match)
+
+    @staticmethod
+    def change_favorite_count(movie_id, delta):
+        # Атомарный UPDATE ... SET favorite_count = favorite_count + delta;
+        # новое значение возвращается тем же запросом (RETURNING), где СУБД это умеет
+        stmt = db.update(Movie).where(Movie.id == movie_id) \
+            .values(favorite_count=Movie.favorite_count + delta)
+        if not db.session.get_bind().dialect.update_returning:
+            db.session.execute(stmt)
+            return db.session.scalar(db.select(Movie.favorite_count).where(Movie.id == movie_id))
+        return db.session.execute(stmt.returning(Movie.favorite_count)).scalar()
+
+    @staticmethod
+    def update_all_favorite_counts():
+        """Пересчет счетчиков избранного по таблице связи (после миграции)"""
+        count = db.select(db.func.count()).where(
+            user_favorites.c.movie_id == Movie.id).scalar_subquery()
+        db.session.execute(db.update(Movie).values(favorite_count=count))
+
+    @classmethod
+    def get_with_favorites(cls, movie_id, user=None):
+        """Фильм и признак is_favorite для user одним запросом.
+
+        Возвращает строку (movie, is_favorite) или None, если фильма нет.
+        """
+        if user is not None and user.is_authenticated:
+            is_favorite = db.exists().where(user_favorites.c.movie_id == cls.id,
+                                            user_favorites.c.user_id == user.id)
         else:
-            self.rating = 0.0
+            is_favorite = db.literal(False)
+        return db.session.execute(
+            db.select(cls, is_favorite.label('is_favorite')).where(cls.id == movie_id)
+        ).first()
 
     def is_favorite_of(self, user):
         if not user or not user.is_authenticated:
             return False
-        return user.is_favorite(self)
-
-    def favorite_count(self):
-        return self.favorited_by.count()
+        return user.is_favorite(self.id)
 
     def to_dict(self, user=None):
+        # Число отзывов и EXISTS по избранному - одним запросом, а не двумя
+        review_count = db.select(db.func.count()).where(Review.movie_id == self.id).scalar_subquery()
+        if not user or not user.is_authenticated:
+            return self._serialize(db.session.execute(db.select(review_count)).scalar())
+        is_favorite = db.exists().where(user_favorites.c.user_id == user.id,
+                                        user_favorites.c.movie_id == self.id)
+        row = db.session.execute(db.select(review_count, is_favorite)).one()
+        return self._serialize(row[0], bool(row[1]))
+
+    def _serialize(self, review_count, is_favorite=None):
         data = {
             'id': self.id,
             'title': self.title,
@@ -118,17 +347,105 @@ class Movie(db.Model):
             'genre': self.genre,
             'rating': self.rating,
             'created_at': self.created_at.isoformat(),
-            'favorite_count': self.favorite_count(),
-            'review_count': self.reviews.count()
+            'favorite_count': self.favorite_count,
+            'review_count': review_count
         }
-        if user and user.is_authenticated:
-            data['is_favorite'] = self.is_favorite_of(user)
+        if is_favorite is not None:
+            data['is_favorite'] = is_favorite
         return data
 
+    @classmethod
+    def api_page(cls, after, limit):
+        """Страница фильмов для API (id > after, по возрастанию id) сразу словарями.
+
+        Только чтение: колонки и число отзывов выбираются одним запросом,
+        без создания ORM-объектов. Поля те же, что у _serialize.
+        """
+        review_count = db.select(db.func.count()).where(Review.movie_id == cls.id) \
+            .scalar_subquery().label('review_count')
+        rows = db.session.execute(
+            db.select(cls.id, cls.title, cls.year, cls.director, cls.description, cls.genre,
+                      cls.rating, cls.created_at, cls.favorite_count, review_count)
+            .where(cls.id > after).order_by(cls.id).limit(limit)
+        ).mappings()
+        return [dict(row, created_at=row['created_at'].isoformat()) for row in rows]
+
+    @staticmethod
+    def review_counts(movie_ids):
+        """Число отзывов для набора фильмов одним запросом: {movie_id: count}"""
+        if not movie_ids:
+            return {}
+        return dict(db.session.execute(
+            db.select(Review.movie_id, db.func.count())
+            .where(Review.movie_id.in_(movie_ids))
+            .group_by(Review.movie_id)
+        ).all())
+
+    @classmethod
+    def to_dict_list(cls, movies, user=None, favorite_ids=None):
+        """Сериализация списка фильмов без отдельных запросов на каждый фильм.
+
+        favorite_ids - уже известное множество избранных фильмов user (тогда
+        оно не запрашивается повторно).
+        """
+        ids = [movie.id for movie in movies]
+        review_counts = cls.review_counts(ids)
+        if favorite_ids is None and user and user.is_authenticated:
+            favorite_ids = user.favorite_ids(ids) if ids else set()
+        return [movie._serialize(review_counts.get(movie.id, 0),
+                                 None if favorite_ids is None else movie.id in favorite_ids)
+                for movie in movies]
+
     def __repr__(self):
         return f'<Movie {self.title} ({self.year})>'
 
 
+def _fts_words(text):
+    # Слова запроса без спецсимволов синтаксиса FTS5
+    return re.findall(r'\w+', text) if text else []
+
+
+# Полнотекстовый индекс SQLite (FTS5) поверх таблицы movie и триггеры синхронизации
+MOVIE_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5(
+        title, genre, director, content='movie', content_rowid='id', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_ai AFTER INSERT ON movie BEGIN
+        INSERT INTO movie_fts(rowid, title, genre, director)
+        VALUES (new.id, new.title, new.genre, new.director);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_ad AFTER DELETE ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title, genre, director)
+        VALUES ('delete', old.id, old.title, old.genre, old.director);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS movie_fts_au AFTER UPDATE OF title, genre, director ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title, genre, director)
+        VALUES ('delete', old.id, old.title, old.genre, old.director);
+        INSERT INTO movie_fts(rowid, title, genre, director)
+        VALUES (new.id, new.title, new.genre, new.director);
+    END""",
+)
+
+
+def create_movie_search(connection):
+    """Создание индекса movie_fts и заполнение его уже существующими фильмами"""
+    for statement in MOVIE_FTS_DDL:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(Movie.__table__, 'after_create')
+def _create_movie_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_movie_search(connection)
+
+
+@event.listens_for(Movie.__table__, 'before_drop')
+def _drop_movie_search(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('DROP TABLE IF EXISTS movie_fts')
+
+
 class Review(db.Model):
     __tablename__ = 'review'
 
@@ -143,9 +460,14 @@ class Review(db.Model):
     __table_args__ = (
         db.UniqueConstraint('user_id', 'movie_id', name='unique_user_movie_review'),
         db.CheckConstraint('rating >= 1 AND rating <= 5', name='rating_range_check'),
+        # Отзывы фильма, отсортированные по дате (страница фильма)
+        db.Index('ix_review_movie_created', movie_id, created_at.desc()),
     )
 
-    def to_dict(self):
+    def to_dict(self, movie_title=None):
+        # movie_title - если название уже известно, фильм не загружается
+        if movie_title is None and self.movie:
+            movie_title = self.movie.title
         return {
             'id': self.id,
             'content': self.content,
@@ -154,8 +476,15 @@ class Review(db.Model):
             'movie_id': self.movie_id,
             'created_at': self.created_at.isoformat(),
             'username': self.user.username if self.user else None,
-            'movie_title': self.movie.title if self.movie else None
+            'movie_title': movie_title
         }
 
     def __repr__(self):
         return f'<Review {self.id} by User {self.user_id} for Movie {self.movie_id}>'
+
+
+@event.listens_for(Movie, 'before_delete')
+def _delete_movie_dependents(mapper, connection, movie):
+    # write_only-коллекции не загружаются при удалении - удаляем зависимые строки сами
+    connection.execute(db.delete(Review.__table__).where(Review.movie_id == movie.id))
+    connection.execute(user_favorites.delete().where(user_favorites.c.movie_id == movie.id))
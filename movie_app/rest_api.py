@@ -1,29 +1,82 @@
 # rest_api.py
-from flask_restful import Resource, reqparse
+from flask_restful import Resource, abort
 from flask_login import login_required, current_user
-from flask import jsonify
+from flask import jsonify, request, url_for
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from models import db, User, Movie, Review
-
-
-# Парсеры для API
-movie_parser = reqparse.RequestParser()
-movie_parser.add_argument('title', required=True, help='Название фильма обязательно')
-movie_parser.add_argument('year', type=int, required=True, help='Год выпуска обязателен')
-movie_parser.add_argument('director')
-movie_parser.add_argument('description')
-movie_parser.add_argument('genre')
-
-review_parser = reqparse.RequestParser()
-review_parser.add_argument('content', required=True, help='Текст отзыва обязателен')
-review_parser.add_argument('rating', type=int, required=True, help='Оценка (1-5) обязательна')
+from schemas import MovieIn, ReviewIn
+from cache import (cache, MOVIE_LIST_KEY, movie_key, invalidate_movie_cache,
+                   invalidate_review_cache, invalidate_favorite_cache)
+
+# Время жизни закэшированных ответов API (секунды)
+API_CACHE_TIMEOUT = 60
+# Размер страницы списков API по умолчанию и максимальный
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 100
+
+
+def parse_body(schema):
+    """Проверка тела запроса (JSON или форма) по pydantic-схеме; при ошибке - 400"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = request.form.to_dict()
+    try:
+        return schema.model_validate(data)
+    except ValidationError as error:
+        fields = {}
+        for item in error.errors():
+            field = str(item['loc'][0]) if item['loc'] else 'body'
+            fields.setdefault(field, schema.messages.get(field, item['msg']))
+        abort(400, message=fields)
+
+
+def page_args():
+    """Параметры keyset-пагинации: ?after=<id последней записи>&limit=<размер страницы>"""
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    return after, min(max(limit, 1), API_MAX_PAGE_SIZE)
+
+
+def conditional(response):
+    """ETag по телу ответа: повторный запрос с If-None-Match получает 304 без тела"""
+    response.add_etag()
+    # В ответе может быть is_favorite текущего пользователя - общим кэшам его хранить нельзя
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def paged_response(items, limit):
+    """Страница списка; ссылка на следующую - в заголовке Link, тело остается списком"""
+    response = jsonify(items)
+    if len(items) == limit:
+        next_url = url_for(request.endpoint, **request.view_args, after=items[-1]['id'], limit=limit)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return conditional(response)
+
+
+def with_favorites(items, user):
+    """Добавляет к закэшированным данным фильмов признак is_favorite текущего пользователя"""
+    if not user.is_authenticated:
+        return items
+    favorite_ids = user.favorite_ids([item['id'] for item in items])
+    return [dict(item, is_favorite=item['id'] in favorite_ids) for item in items]
 
 
 # API для фильмов
 class MovieListAPI(Resource):
     def get(self):
-        # Список всех фильмов
-        movies = Movie.query.all()
-        return jsonify([movie.to_dict(current_user) for movie in movies])
+        # Список фильмов постранично (по возрастанию id)
+        after, limit = page_args()
+        # Кэшируется первая страница стандартного размера - ее запрашивают чаще всего
+        cacheable = after == 0 and limit == API_PAGE_SIZE
+        movies = cache.get(MOVIE_LIST_KEY) if cacheable else None
+        if movies is None:
+            movies = Movie.api_page(after, limit)
+            if cacheable:
+                cache.set(MOVIE_LIST_KEY, movies, timeout=API_CACHE_TIMEOUT)
+        return paged_response(with_favorites(movies, current_user), limit)
 
     @login_required
     def post(self):
@@ -31,18 +84,13 @@ class MovieListAPI(Resource):
         if not current_user.is_admin:
             return {'error': 'Только администраторы могут добавлять фильмы'}, 403
 
-        args = movie_parser.parse_args()
+        args = parse_body(MovieIn)
 
-        movie = Movie(
-            title=args['title'],
-            year=args['year'],
-            director=args.get('director'),
-            description=args.get('description'),
-            genre=args.get('genre')
-        )
+        movie = Movie(**args.model_dump())
 
         db.session.add(movie)
         db.session.commit()
+        invalidate_movie_cache(movie.id)
 
         return movie.to_dict(current_user), 201
 
@@ -50,8 +98,11 @@ class MovieListAPI(Resource):
 class MovieAPI(Resource):
     def get(self, movie_id):
         # Информацию о фильме по ID
-        movie = Movie.query.get_or_404(movie_id)
-        return jsonify(movie.to_dict(current_user))
+        data = cache.get(movie_key(movie_id))
+        if data is None:
+            data = Movie.to_dict_list([Movie.query.get_or_404(movie_id)])[0]
+            cache.set(movie_key(movie_id), data, timeout=API_CACHE_TIMEOUT)
+        return conditional(jsonify(with_favorites([data], current_user)[0]))
 
     @login_required
     def put(self, movie_id):
@@ -60,15 +111,13 @@ class MovieAPI(Resource):
             return {'error': 'Только администраторы могут редактировать фильмы'}, 403
 
         movie = Movie.query.get_or_404(movie_id)
-        args = movie_parser.parse_args()
+        args = parse_body(MovieIn)
 
-        movie.title = args['title']
-        movie.year = args['year']
-        movie.director = args.get('director')
-        movie.description = args.get('description')
-        movie.genre = args.get('genre')
+        for field, value in args.model_dump().items():
+            setattr(movie, field, value)
 
         db.session.commit()
+        invalidate_movie_cache(movie_id)
         return movie.to_dict(current_user)
 
     @login_required
@@ -80,46 +129,57 @@ class MovieAPI(Resource):
         movie = Movie.query.get_or_404(movie_id)
         db.session.delete(movie)
         db.session.commit()
+        invalidate_movie_cache(movie_id)
         return {'message': 'Фильм удален'}
 
 
 # API для отзывов
 class ReviewListAPI(Resource):
     def get(self, movie_id):
-        # Получить все отзывы к фильму
-        reviews = Review.query.filter_by(movie_id=movie_id).all()
-        return jsonify([review.to_dict() for review in reviews])
+        # Отзывы к фильму постранично; автор и фильм нужны to_dict - грузим их тем же запросом
+        after, limit = page_args()
+        reviews = (Review.query
+                   .options(joinedload(Review.user), joinedload(Review.movie))
+                   .filter(Review.movie_id == movie_id, Review.id > after)
+                   .order_by(Review.id)
+                   .limit(limit)
+                   .all())
+        return paged_response([review.to_dict() for review in reviews], limit)
 
     @login_required
     def post(self, movie_id):
         # Добавить отзыв к фильму
-        args = review_parser.parse_args()
-
-        # Проверяем, есть ли уже отзыв от этого пользователя
-        existing = Review.query.filter_by(
-            movie_id=movie_id,
-            user_id=current_user.id
-        ).first()
+        args = parse_body(ReviewIn)
 
-        if existing:
-            return {'error': 'Вы уже оставляли отзыв на этот фильм'}, 400
+        # Рейтинг обновляется по хранимым сумме и числу оценок; этот же UPDATE
+        # заменяет проверку существования фильма (SQLite не проверяет внешние ключи)
+        # и возвращает название фильма для ответа
+        movie_title = Movie.change_rating(movie_id, args.rating, 1)
+        if movie_title is None:
+            db.session.rollback()
+            abort(404)
 
         review = Review(
-            content=args['content'],
-            rating=args['rating'],
+            content=args.content,
+            rating=args.rating,
             user_id=current_user.id,
             movie_id=movie_id
         )
 
         db.session.add(review)
+        try:
+            # Повторный отзыв отсекает уникальное ограничение (user_id, movie_id);
+            # откат отменяет и изменение рейтинга
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return {'error': 'Вы уже оставляли отзыв на этот фильм'}, 400
 
-        # Обновляем рейтинг фильма
-        movie = Movie.query.get(movie_id)
-        if movie:
-            movie.update_rating()
-
+        # Сериализуем до commit: после него все атрибуты пришлось бы перечитывать
+        data = review.to_dict(movie_title)
         db.session.commit()
-        return review.to_dict(), 201
+        invalidate_review_cache(movie_id)
+        return data, 201
 
 
 class ReviewAPI(Resource):
@@ -139,12 +199,11 @@ class ReviewAPI(Resource):
         movie_id = review.movie_id
         db.session.delete(review)
 
-        # Обновляем рейтинг фильма
-        movie = Movie.query.get(movie_id)
-        if movie:
-            movie.update_rating()
+        # Обновляем рейтинг фильма по хранимым сумме и числу оценок
+        Movie.change_rating(movie_id, review.rating, -1)
 
         db.session.commit()
+        invalidate_review_cache(movie_id)
         return {'message': 'Отзыв удален'}
 
 
@@ -157,7 +216,7 @@ class UserListAPI(Resource):
             return {'error': 'Только администраторы могут просматривать список пользователей'}, 403
 
         users = User.query.all()
-        return jsonify([user.to_dict() for user in users])
+        return jsonify(User.to_dict_list(users))
 
 
 class UserAPI(Resource):
@@ -175,56 +234,66 @@ class UserAPI(Resource):
 class FavoriteAPI(Resource):
     @login_required
     def post(self, movie_id):
-        # Добавить фильм в избранное
-        movie = Movie.query.get_or_404(movie_id)
-
-        if current_user.is_favorite(movie):
+        # Добавить фильм в избранное: вставка и новый счетчик - без предварительного SELECT фильма
+        favorite_count = current_user.add_favorite(movie_id)
+        if favorite_count is None:
+            # Ничего не вставилось: фильма нет или он уже в избранном
+            if db.session.get(Movie, movie_id) is None:
+                abort(404)
             return {'error': 'Фильм уже в избранном'}, 400
 
-        current_user.add_favorite(movie)
         db.session.commit()
+        invalidate_favorite_cache(movie_id)
 
         return {
             'message': 'Фильм добавлен в избранное',
             'is_favorite': True,
-            'favorite_count': movie.favorite_count()
+            'favorite_count': favorite_count
         }, 201
 
     @login_required
     def delete(self, movie_id):
         # Удалить фильм из избранного
-        movie = Movie.query.get_or_404(movie_id)
-
-        if not current_user.is_favorite(movie):
+        favorite_count = current_user.remove_favorite(movie_id)
+        if favorite_count is None:
+            if db.session.get(Movie, movie_id) is None:
+                abort(404)
             return {'error': 'Фильм не в избранном'}, 400
 
-        current_user.remove_favorite(movie)
         db.session.commit()
+        invalidate_favorite_cache(movie_id)
 
         return {
             'message': 'Фильм удален из избранного',
             'is_favorite': False,
-            'favorite_count': movie.favorite_count()
+            'favorite_count': favorite_count
         }
 
     @login_required
     def get(self, movie_id):
         # Проверить, в избранном ли фильм
-        movie = Movie.query.get_or_404(movie_id)
-        is_favorite = current_user.is_favorite(movie)
+        row = Movie.get_with_favorites(movie_id, current_user)
+        if row is None:
+            abort(404)
 
-        return {
-            'is_favorite': is_favorite,
-            'favorite_count': movie.favorite_count()
-        }
+        is_favorite = bool(row.is_favorite)
+        favorite_count = row.Movie.favorite_count
+        response = jsonify({'is_favorite': is_favorite, 'favorite_count': favorite_count})
+        # Клиент, опрашивающий состояние, с тем же ETag получает 304 без тела;
+        # no-cache - после переключения избранного ответ всегда перепроверяется
+        response.set_etag(f'{movie_id}-{favorite_count}-{int(is_favorite)}')
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
 
 
 class FavoriteListAPI(Resource):
     @login_required
     def get(self):
         # Получить список избранных фильмов пользователя
-        favorites = current_user.favorite_movies.all()
-        return jsonify([movie.to_dict(current_user) for movie in favorites])
+        # Все фильмы списка избранные - признак is_favorite известен без запроса
+        favorites = current_user.favorite_movies
+        return jsonify(Movie.to_dict_list(favorites, current_user,
+                                          favorite_ids={movie.id for movie in favorites}))
 
 
 def register_api_resources(api):
@@ -0,0 +1,34 @@
+# schemas.py
+from typing import ClassVar
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class MovieIn(BaseModel):
+    """Данные фильма в запросах API"""
+    model_config = ConfigDict(extra='ignore')
+
+    # Сообщения об ошибках по полям
+    messages: ClassVar[dict] = {
+        'title': 'Название фильма обязательно',
+        'year': 'Год выпуска обязателен (1900-2100)',
+    }
+
+    title: str
+    year: int = Field(ge=1900, le=2100)
+    director: str | None = None
+    description: str | None = None
+    genre: str | None = None
+
+
+class ReviewIn(BaseModel):
+    """Данные отзыва в запросах API"""
+    model_config = ConfigDict(extra='ignore')
+
+    messages: ClassVar[dict] = {
+        'content': 'Текст отзыва обязателен',
+        'rating': 'Оценка (1-5) обязательна',
+    }
+
+    content: str
+    rating: int = Field(ge=1, le=5)
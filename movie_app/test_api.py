@@ -1,90 +1,169 @@
 import unittest
-import tempfile
 import os
 import json
 import sys
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, raiseload, scoped_session, sessionmaker
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# Движок создается при импорте app, поэтому БД для тестов задается до него:
+# SQLite в памяти (Flask-SQLAlchemy сам выбирает StaticPool - одно соединение на все
+# запросы), без файлов на диске и без риска затронуть instance/movies.db
+os.environ['DATABASE_URL'] = 'sqlite://'
+# Стойкость хэша паролей тестам не нужна: одна итерация PBKDF2 вместо scrypt
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1'
+
+
+@contextmanager
+def count_queries(engine):
+    # Собирает SQL-запросы, выполненные внутри блока
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def insert_rows(db, model, rows, key):
+    # Один executemany на таблицу вместо add() на каждую строку. SQLite не гарантирует
+    # порядок RETURNING в пакете, поэтому id читаются одним запросом по уникальному key
+    db.session.execute(db.insert(model), rows)
+    column = getattr(model, key)
+    keys = [row[key] for row in rows]
+    ids = dict(db.session.execute(db.select(column, model.id).where(column.in_(keys))).all())
+    return [ids[value] for value in keys]
+
+
+def password_hash(app, password):
+    # Хэш тем же методом, что и User.set_password (без пересчета при входе)
+    from werkzeug.security import generate_password_hash
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+
+@contextmanager
+def no_lazy_loads():
+    # Внутри блока обращение к незагруженной связи вызывает исключение (ловим N+1)
+    def add_raiseload(orm_execute_state):
+        if (orm_execute_state.is_select and not orm_execute_state.is_column_load
+                and not orm_execute_state.is_relationship_load):
+            orm_execute_state.statement = orm_execute_state.statement.options(raiseload('*'))
+
+    event.listen(Session, 'do_orm_execute', add_raiseload)
+    try:
+        yield
+    finally:
+        event.remove(Session, 'do_orm_execute', add_raiseload)
+
+
+def _driver_autocommit(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _emit_begin(connection):
+    connection.exec_driver_sql('BEGIN')
+
+
+def use_savepoints(engine):
+    # pysqlite сам решает, когда начинать транзакцию, и SAVEPOINT внутри внешней
+    # транзакции у него не работает - выключаем это и начинаем транзакции явно
+    if event.contains(engine, 'begin', _emit_begin):
+        return
+    event.listen(engine, 'connect', _driver_autocommit)
+    event.listen(engine, 'begin', _emit_begin)
+    # Соединение могло быть открыто до подписки на события - пересоздаем
+    engine.dispose()
 
-class MovieAPITestCase(unittest.TestCase):
-    def setUp(self):
-        # Временная БД - SQLite в памяти или временный файл
-        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
 
+class DatabaseTestCase(unittest.TestCase):
+    """Схема и фикстуры создаются один раз на класс (create_fixtures).
+
+    Каждый тест идет внутри транзакции отдельного соединения: commit() приложения
+    становится SAVEPOINT, а в tearDown вся транзакция откатывается.
+    """
+
+    @classmethod
+    def setUpClass(cls):
         # Импортируем здесь чтобы избежать конфликтов с основной БД
         from app import app, db
         from models import User, Movie, Review
 
-        self.app = app
-        self.db = db
-        self.User = User
-        self.Movie = Movie
-        self.Review = Review
+        cls.app = app
+        cls.db = db
+        cls.User = User
+        cls.Movie = Movie
+        cls.Review = Review
 
         # Переопределяем конфигурацию для тестов
-        self.app.config['TESTING'] = True
-        self.app.config['DEBUG'] = False
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
-        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        self.app.config['WTF_CSRF_ENABLED'] = False
-        self.app.config['SECRET_KEY'] = 'test-secret-key-for-testing'
-        self.app.config['LOGIN_DISABLED'] = False
+        cls.app.config['TESTING'] = True
+        cls.app.config['DEBUG'] = False
+        cls.app.config['WTF_CSRF_ENABLED'] = False
+        cls.app.config['SECRET_KEY'] = 'test-secret-key-for-testing'
+        cls.app.config['LOGIN_DISABLED'] = False
+
+        with cls.app.app_context():
+            use_savepoints(cls.db.engine)
+            cls.db.create_all()
+            cls.create_fixtures()
+            cls.db.session.commit()
+            cls.db.session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.app.app_context():
+            cls.db.drop_all()
+
+    @classmethod
+    def create_fixtures(cls):
+        pass
 
+    def setUp(self):
         self.client = self.app.test_client()
 
-        with self.app.app_context():
-            # Создаем все таблицы
-            self.db.create_all()
-
-            # Тестовый админ
-            admin = self.User(username='testadmin', email='admin@test.com', is_admin=True)
-            admin.set_password('admin123')
-            self.db.session.add(admin)
-
-            # Тестовый обычный пользователь
-            user = self.User(username='testuser', email='user@test.com', is_admin=False)
-            user.set_password('user123')
-            self.db.session.add(user)
-
-            # Тестовые фильмы
-            movie1 = self.Movie(
-                title='Test Movie 1',
-                year=2024,
-                director='Director 1',
-                genre='Drama',
-                description='Description 1'
-            )
-            movie2 = self.Movie(
-                title='Test Movie 2',
-                year=2023,
-                director='Director 2',
-                genre='Comedy',
-                description='Description 2'
-            )
-            self.db.session.add(movie1)
-            self.db.session.add(movie2)
+        # Кэш общий для всех тестов - сбрасываем данные предыдущих
+        from cache import cache
+        cache.clear()
 
-            self.db.session.commit()
-
-            self.admin_id = admin.id
-            self.user_id = user.id
-            self.movie1_id = movie1.id
-            self.movie2_id = movie2.id
-
-    def tearDown(self):
-        # Очистка после каждого теста
         with self.app.app_context():
-            # Удаляем все таблицы
-            self.db.session.remove()
-            self.db.drop_all()
+            self.connection = self.db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = self.db.session
+        self.db.session = scoped_session(sessionmaker(
+            bind=self.connection, join_transaction_mode='create_savepoint'))
 
-        # Закрываем файловый дескриптор и удаляем временный файл
-        os.close(self.db_fd)
-        try:
-            os.unlink(self.db_path)
-        except:
-            pass
+    def tearDown(self):
+        # Откатываем все, что сделал тест
+        self.db.session.remove()
+        self.db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+
+
+class MovieAPITestCase(DatabaseTestCase):
+    @classmethod
+    def create_fixtures(cls):
+        # Тестовые админ и обычный пользователь
+        cls.admin_id, cls.user_id = insert_rows(cls.db, cls.User, [
+            {'username': 'testadmin', 'email': 'admin@test.com', 'is_admin': True,
+             'password_hash': password_hash(cls.app, 'admin123')},
+            {'username': 'testuser', 'email': 'user@test.com', 'is_admin': False,
+             'password_hash': password_hash(cls.app, 'user123')},
+        ], key='username')
+
+        # Тестовые фильмы
+        cls.movie1_id, cls.movie2_id = insert_rows(cls.db, cls.Movie, [
+            {'title': 'Test Movie 1', 'year': 2024, 'director': 'Director 1',
+             'genre': 'Drama', 'description': 'Description 1'},
+            {'title': 'Test Movie 2', 'year': 2023, 'director': 'Director 2',
+             'genre': 'Comedy', 'description': 'Description 2'},
+        ], key='title')
 
     def login_as_user(self, user_id=None):
         # Авторизуем пользователя в тестовом контексте
@@ -114,6 +193,19 @@ class MovieAPITestCase(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(len(data), 2)
 
+    def test_get_movies_paginated(self):
+        # Список отдается страницами; ссылка на следующую - в заголовке Link
+        response = self.client.get('/api/v1/movies/?limit=1')
+        self.assertEqual([movie['id'] for movie in response.get_json()], [self.movie1_id])
+        self.assertIn(f'after={self.movie1_id}', response.headers['Link'])
+
+        response = self.client.get(f'/api/v1/movies/?limit=1&after={self.movie1_id}')
+        self.assertEqual([movie['id'] for movie in response.get_json()], [self.movie2_id])
+
+        response = self.client.get(f'/api/v1/movies/?limit=1&after={self.movie2_id}')
+        self.assertEqual(response.get_json(), [])
+        self.assertNotIn('Link', response.headers)
+
     def test_get_single_movie_without_auth(self):
         # Тест получения одного фильма без авторизации
         response = self.client.get(f'/api/v1/movies/{self.movie1_id}')
@@ -165,6 +257,68 @@ class MovieAPITestCase(unittest.TestCase):
         self.assertEqual(data['content'], 'Very good movie!')
         self.assertEqual(data['rating'], 5)
 
+    def test_create_duplicate_review_rejected(self):
+        # Второй отзыв на тот же фильм отклоняется, первый остается
+        self.login_as_user('user')
+        url = f'/api/v1/movies/{self.movie1_id}/reviews/'
+        self.client.post(url, json={'content': 'Первый отзыв', 'rating': 5})
+
+        response = self.client.post(url, json={'content': 'Второй отзыв', 'rating': 1})
+        self.assertEqual(response.status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(self.Review.query.filter_by(movie_id=self.movie1_id).count(), 1)
+            self.assertEqual(self.db.session.get(self.Movie, self.movie1_id).rating, 5.0)
+
+    def test_create_review_statements(self):
+        # Успешный отзыв: загрузка пользователя, UPDATE рейтинга (название фильма
+        # через RETURNING) и INSERT отзыва - без отдельного SELECT фильма
+        self.login_as_user('user')
+        with self.app.app_context():
+            with count_queries(self.db.engine) as queries:
+                response = self.client.post(f'/api/v1/movies/{self.movie1_id}/reviews/',
+                                            json={'content': 'Отлично', 'rating': 5})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['movie_title'], 'Test Movie 1')
+        self.assertEqual(response.get_json()['username'], 'testuser')
+
+        # SAVEPOINT/RELEASE тестовой транзакции не считаем
+        statements = [query.split(None, 1)[0].upper() for query in queries
+                      if query.split(None, 1)[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual(statements, ['SELECT', 'UPDATE', 'INSERT'])
+
+    def test_create_review_for_missing_movie(self):
+        # Отзыв к несуществующему фильму не сохраняется
+        self.login_as_user('user')
+        response = self.client.post('/api/v1/movies/999/reviews/', json={'content': 'Отлично', 'rating': 5})
+        self.assertEqual(response.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(self.Review.query.count(), 0)
+
+    def test_rating_follows_review_add_and_delete(self):
+        # Рейтинг пересчитывается по хранимым сумме и числу оценок
+        url = f'/api/v1/movies/{self.movie1_id}/reviews/'
+        self.login_as_user('user')
+        self.client.post(url, json={'content': 'Отлично', 'rating': 5})
+        self.login_as_user('admin')
+        review_id = self.client.post(url, json={'content': 'Так себе', 'rating': 2}).get_json()['id']
+
+        with self.app.app_context():
+            movie = self.db.session.get(self.Movie, self.movie1_id)
+            self.assertEqual((movie.rating, movie.rating_sum, movie.rating_count), (3.5, 7, 2))
+
+        self.client.delete(f'/api/v1/reviews/{review_id}')
+        with self.app.app_context():
+            movie = self.db.session.get(self.Movie, self.movie1_id)
+            self.assertEqual((movie.rating, movie.rating_sum, movie.rating_count), (5.0, 5, 1))
+
+    def test_create_review_invalid_rating(self):
+        # Оценка вне диапазона 1-5 отклоняется с сообщением по полю
+        self.login_as_user('user')
+        response = self.client.post(f'/api/v1/movies/{self.movie1_id}/reviews/',
+                                    json={'content': 'Слишком щедро', 'rating': 7})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('rating', response.get_json()['message'])
+
     def test_create_movie_as_user_forbidden(self):
         # Тест создания фильма обычным пользователем
         self.login_as_user('user')
@@ -193,6 +347,112 @@ class MovieAPITestCase(unittest.TestCase):
         response = self.client.delete(f'/api/v1/movies/{self.movie1_id}/favorite/')
         self.assertIn(response.status_code, [200, 204])
 
+    def test_movie_list_counts_without_per_movie_queries(self):
+        # Счетчики в списке фильмов верны, связи не догружаются,
+        # а число запросов не зависит от числа фильмов
+        self.login_as_user('user')
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/favorite/')
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/reviews/',
+                         json={'content': 'Хороший фильм', 'rating': 4})
+
+        def list_queries():
+            with self.app.app_context():
+                with count_queries(self.db.engine) as queries, no_lazy_loads():
+                    response = self.client.get('/api/v1/movies/')
+                self.assertEqual(response.status_code, 200)
+                return response.get_json(), len(queries)
+
+        movies, two_movies = list_queries()
+        by_id = {movie['id']: movie for movie in movies}
+        self.assertEqual(by_id[self.movie1_id]['favorite_count'], 1)
+        self.assertEqual(by_id[self.movie1_id]['review_count'], 1)
+        self.assertTrue(by_id[self.movie1_id]['is_favorite'])
+        self.assertEqual(by_id[self.movie2_id]['review_count'], 0)
+        self.assertFalse(by_id[self.movie2_id]['is_favorite'])
+
+        with self.app.app_context():
+            for i in range(3):
+                self.db.session.add(self.Movie(title=f'Extra {i}', year=2000 + i))
+            self.db.session.commit()
+        # Фильмы добавлены мимо API - сбрасываем закэшированный список вручную
+        from cache import cache
+        cache.clear()
+        movies, five_movies = list_queries()
+        self.assertEqual(len(movies), 5)
+        self.assertEqual(five_movies, two_movies)
+
+    def test_favorite_count_column_follows_toggles(self):
+        # Повторное добавление не увеличивает счетчик, удаление уменьшает
+        self.login_as_user('user')
+        url = f'/api/v1/movies/{self.movie1_id}/favorite/'
+        self.assertEqual(self.client.post(url).get_json()['favorite_count'], 1)
+        self.assertEqual(self.client.post(url).status_code, 400)
+        self.login_as_user('admin')
+        self.assertEqual(self.client.post(url).get_json()['favorite_count'], 2)
+        self.assertEqual(self.client.delete(url).get_json()['favorite_count'], 1)
+
+        with self.app.app_context():
+            self.assertEqual(self.db.session.get(self.Movie, self.movie1_id).favorite_count, 1)
+
+    def test_favorite_missing_movie_not_found(self):
+        # Для несуществующего фильма строка избранного не создается
+        self.login_as_user('user')
+        self.assertEqual(self.client.post('/api/v1/movies/999/favorite/').status_code, 404)
+        self.assertEqual(self.client.delete('/api/v1/movies/999/favorite/').status_code, 404)
+        self.assertEqual(self.client.delete(f'/api/v1/movies/{self.movie1_id}/favorite/').status_code, 400)
+
+        from models import user_favorites
+        with self.app.app_context():
+            favorites = self.db.session.execute(
+                self.db.select(self.db.func.count()).select_from(user_favorites)).scalar()
+            self.assertEqual(favorites, 0)
+
+    def test_favorite_status_conditional_get(self):
+        # Повторный запрос с тем же ETag получает 304, после изменения - новый ответ
+        self.login_as_user('user')
+        url = f'/api/v1/movies/{self.movie1_id}/favorite/'
+        etag = self.client.get(url).headers['ETag']
+
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        self.client.post(url)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.get_json()['is_favorite'])
+
+    def test_movie_list_items_match_single_movie(self):
+        # Строка списка (выборка колонок) совпадает с сериализацией отдельного фильма
+        self.login_as_user('user')
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/reviews/',
+                         json={'content': 'Хороший фильм', 'rating': 4})
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/favorite/')
+
+        listed = {movie['id']: movie for movie in self.client.get('/api/v1/movies/').get_json()}
+        for movie_id in (self.movie1_id, self.movie2_id):
+            single = self.client.get(f'/api/v1/movies/{movie_id}').get_json()
+            self.assertEqual(list(listed[movie_id].items()), list(single.items()))
+
+    def test_movie_list_conditional_get(self):
+        # Неизменившийся список отдается как 304, после добавления фильма - заново
+        etag = self.client.get('/api/v1/movies/').headers['ETag']
+        self.assertEqual(self.client.get('/api/v1/movies/', headers={'If-None-Match': etag}).status_code, 304)
+
+        self.login_as_user('admin')
+        self.client.post('/api/v1/movies/', json={'title': 'New Movie', 'year': 2020})
+        response = self.client.get('/api/v1/movies/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_cached_movie_refreshed_after_favorite(self):
+        # Закэшированный ответ API сбрасывается при изменении избранного
+        self.login_as_user('user')
+        url = f'/api/v1/movies/{self.movie1_id}'
+        self.assertEqual(self.client.get(url).get_json()['favorite_count'], 0)
+
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/favorite/')
+        data = self.client.get(url).get_json()
+        self.assertEqual(data['favorite_count'], 1)
+        self.assertTrue(data['is_favorite'])
+
     # ========== ТЕСТЫ С АВТОРИЗАЦИЕЙ АДМИНА ==========
 
     def test_create_movie_as_admin(self):
@@ -238,6 +498,51 @@ class MovieAPITestCase(unittest.TestCase):
         response = self.client.get(f'/api/v1/movies/{self.movie1_id}')
         self.assertEqual(response.status_code, 404)
 
+    def test_delete_movie_removes_reviews_and_favorites(self):
+        # Отзывы и строки избранного удаляются вместе с фильмом
+        self.login_as_user('user')
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/reviews/', json={'content': 'Отлично', 'rating': 5})
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/favorite/')
+
+        self.login_as_user('admin')
+        self.assertEqual(self.client.delete(f'/api/v1/movies/{self.movie1_id}').status_code, 200)
+
+        from models import user_favorites
+        with self.app.app_context():
+            self.assertEqual(self.Review.query.filter_by(movie_id=self.movie1_id).count(), 0)
+            favorites = self.db.session.execute(
+                self.db.select(self.db.func.count()).select_from(user_favorites)).scalar()
+            self.assertEqual(favorites, 0)
+
+    def test_reinit_db_resets_data(self):
+        # Пересоздание базы удаляет добавленные данные и заново заполняет тестовыми
+        from init_db import reinit_db, _load_seed
+        seed = _load_seed()
+        self.login_as_user('user')
+        self.client.post(f'/api/v1/movies/{self.movie1_id}/favorite/')
+        self.assertEqual(len(self.client.get('/api/v1/movies/').get_json()), 2)
+
+        self.assertTrue(reinit_db(self.app))
+
+        with self.app.app_context():
+            titles = set(self.db.session.scalars(self.db.select(self.Movie.title)))
+            self.assertEqual(titles, {movie['title'] for movie in seed['movies']})
+            self.assertEqual(self.Review.query.count(), len(seed['reviews']))
+            usernames = set(self.db.session.scalars(self.db.select(self.User.username)))
+            self.assertEqual(usernames, {'admin', 'user'})
+        # Закэшированный список тоже сброшен
+        self.assertEqual(len(self.client.get('/api/v1/movies/').get_json()), len(seed['movies']))
+
+    def test_reinit_db_failure_keeps_data(self):
+        # Ошибка посреди пересоздания откатывает и удаление
+        from unittest import mock
+        import init_db
+        with mock.patch.object(init_db, 'seed_data', side_effect=RuntimeError('seed failed')), \
+                self.assertLogs(self.app.logger, level='ERROR'):
+            self.assertFalse(init_db.reinit_db(self.app))
+        with self.app.app_context():
+            self.assertEqual(self.Movie.query.count(), 2)
+
     # ========== БАЗОВЫЕ ТЕСТЫ ==========
 
     def test_database_operations(self):
@@ -254,50 +559,27 @@ class MovieAPITestCase(unittest.TestCase):
 
 
 # Простые тесты веб-интерфейса
-class WebInterfaceTestCase(unittest.TestCase):
-    def setUp(self):
-        # Временная БД в памяти для веб-тестов
-        from app import app, db
-        from models import User, Movie
-
-        self.app = app
-        self.db = db
-        self.User = User
-        self.Movie = Movie
-
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-        self.app.config['WTF_CSRF_ENABLED'] = False
-        self.app.config['SECRET_KEY'] = 'test-secret-key'
-
-        self.client = self.app.test_client()
-
-        with self.app.app_context():
-            self.db.create_all()
-
-            # Создаем тестового пользователя
-            user = self.User(username='testuser', email='test@test.com')
-            user.set_password('test123')
-            self.db.session.add(user)
-
-            # Создаем тестовый фильм
-            movie = self.Movie(
-                title='Test Web Movie',
-                year=2024,
-                director='Web Director',
-                genre='Web Genre'
-            )
-            self.db.session.add(movie)
-
-            self.db.session.commit()
-
-            self.user_id = user.id
-            self.movie_id = movie.id
-
-    def tearDown(self):
-        with self.app.app_context():
-            self.db.session.remove()
-            self.db.drop_all()
+class WebInterfaceTestCase(DatabaseTestCase):
+    @classmethod
+    def create_fixtures(cls):
+        # Создаем тестового пользователя
+        user = cls.User(username='testuser', email='test@test.com')
+        user.set_password('test123')
+        cls.db.session.add(user)
+
+        # Создаем тестовый фильм
+        movie = cls.Movie(
+            title='Test Web Movie',
+            year=2024,
+            director='Web Director',
+            genre='Web Genre'
+        )
+        cls.db.session.add(movie)
+
+        cls.db.session.flush()
+
+        cls.user_id = user.id
+        cls.movie_id = movie.id
 
     def test_home_page(self):
         # Тест главной страницы
@@ -315,6 +597,14 @@ class WebInterfaceTestCase(unittest.TestCase):
         response_text = response.get_data(as_text=True)
         self.assertIn('Test Web Movie', response_text)
 
+    def test_genre_filter_lists_single_genres(self):
+        # Жанры через запятую разбиваются на отдельные пункты фильтра
+        from app import get_genres
+        with self.app.app_context():
+            self.db.session.add(self.Movie(title='Combo', year=2020, genre='Drama, Web Genre'))
+            self.db.session.commit()
+            self.assertEqual(get_genres(), ['Drama', 'Web Genre'])
+
     def test_movie_detail_page(self):
         # Тест страницы фильма
         response = self.client.get(f'/movie/{self.movie_id}')
@@ -322,49 +612,127 @@ class WebInterfaceTestCase(unittest.TestCase):
         response_text = response.get_data(as_text=True)
         self.assertIn('Test Web Movie', response_text)
 
+    def test_movie_detail_reviews_page_out_of_range(self):
+        # Несуществующая страница отзывов - страница фильма все равно открывается
+        for rpage in (5, 0):
+            response = self.client.get(f'/movie/{self.movie_id}?rpage={rpage}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Test Web Movie', response.get_data(as_text=True))
+
+    def test_toggle_favorite_reports_unchanged_state(self):
+        # Повторное "добавить" не сообщает о добавлении, "удалить" лишнее - тоже
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user_id)
+        url = f'/movie/{self.movie_id}/favorite'
+
+        text = self.client.post(url, data={'action': 'add'}, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('добавлен в избранное', text)
+        text = self.client.post(url, data={'action': 'add'}, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('уже в избранном', text)
+        self.assertNotIn('добавлен в избранное', text)
+
+        self.client.post(url, data={'action': 'remove'})
+        text = self.client.post(url, data={'action': 'remove'}, follow_redirects=True).get_data(as_text=True)
+        self.assertIn('не в избранном', text)
+        with self.app.app_context():
+            self.assertEqual(self.db.session.get(self.Movie, self.movie_id).favorite_count, 0)
 
-# Тесты API с русскими символами (используем правильное кодирование)
-class RussianAPITestCase(unittest.TestCase):
-    def setUp(self):
-        from app import app, db
-        from models import User, Movie
-
-        self.app = app
-        self.db = db
-        self.User = User
-        self.Movie = Movie
+    def test_remove_favorite_from_movie_list(self):
+        # Карточка избранного фильма в списке предлагает удалить его
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user_id)
+        url = f'/movie/{self.movie_id}/favorite'
+        self.client.post(url, data={'action': 'add'})
 
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
-        self.app.config['WTF_CSRF_ENABLED'] = False
-        self.app.config['SECRET_KEY'] = 'test-secret-key'
+        text = self.client.get('/movies').get_data(as_text=True)
+        self.assertIn('value="remove"', text)
+        self.assertNotIn('value="add"', text)
 
-        self.client = self.app.test_client()
+        self.client.post(url, data={'action': 'remove'})
+        with self.app.app_context():
+            self.assertEqual(self.db.session.get(self.Movie, self.movie_id).favorite_count, 0)
+        text = self.client.get('/movies').get_data(as_text=True)
+        self.assertIn('value="add"', text)
+
+    def test_login_rehashes_once_for_short_method(self):
+        # Короткий метод 'scrypt' хранится как 'scrypt:32768:8:1$...' -
+        # второй вход хэш уже не пересчитывает
+        self.addCleanup(self.app.config.__setitem__, 'PASSWORD_HASH_METHOD',
+                        self.app.config['PASSWORD_HASH_METHOD'])
+        self.app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+        hashes = []
+        for _ in range(2):
+            with self.client.session_transaction() as sess:
+                sess.clear()
+            response = self.client.post('/login', data={'username': 'testuser', 'password': 'test123'})
+            self.assertEqual(response.status_code, 302)
+            with self.app.app_context():
+                hashes.append(self.db.session.get(self.User, self.user_id).password_hash)
+        self.assertTrue(hashes[0].startswith('scrypt:32768:8:1$'))
+        self.assertEqual(hashes[1], hashes[0])
+
+    def test_register_existing_username(self):
+        # Повторная регистрация с занятым именем не создает пользователя
+        response = self.client.post('/register', data={
+            'username': 'testuser',
+            'password': 'secret123',
+            'password2': 'secret123'
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/register'))
 
         with self.app.app_context():
-            self.db.create_all()
+            self.assertEqual(self.User.query.filter_by(username='testuser').count(), 1)
 
-            # Создаем тестового пользователя с русским именем
-            user = self.User(username='test_user')
-            user.set_password('test123')
-            self.db.session.add(user)
+    def test_movie_detail_queries_do_not_grow_with_reviews(self):
+        # Число запросов страницы фильма не зависит от количества отзывов
+        from models import Review
 
-            # Создаем тестовый фильм с русским названием
-            movie = self.Movie(
-                title='Тестовый фильм',
-                year=2024,
-                director='Тестовый режиссер'
-            )
-            self.db.session.add(movie)
+        def detail_queries():
+            with self.app.app_context():
+                with count_queries(self.db.engine) as queries, no_lazy_loads():
+                    response = self.client.get(f'/movie/{self.movie_id}')
+                self.assertEqual(response.status_code, 200)
+                return len(queries)
 
+        with self.app.app_context():
+            self.db.session.add(Review(content='Первый отзыв', rating=4,
+                                       user_id=self.user_id, movie_id=self.movie_id))
             self.db.session.commit()
+        single_review = detail_queries()
 
-            self.movie_id = movie.id
-
-    def tearDown(self):
         with self.app.app_context():
-            self.db.session.remove()
-            self.db.drop_all()
+            hashed = password_hash(self.app, 'test123')
+            user_ids = insert_rows(self.db, self.User, [
+                {'username': f'reviewer{i}', 'password_hash': hashed} for i in range(4)], key='username')
+            self.db.session.execute(self.db.insert(Review), [
+                {'content': f'Отзыв номер {i}', 'rating': 5, 'user_id': user_id, 'movie_id': self.movie_id}
+                for i, user_id in enumerate(user_ids)])
+            self.db.session.commit()
+
+        self.assertEqual(detail_queries(), single_review)
+
+
+# Тесты API с русскими символами (используем правильное кодирование)
+class RussianAPITestCase(DatabaseTestCase):
+    @classmethod
+    def create_fixtures(cls):
+        # Создаем тестового пользователя с русским именем
+        user = cls.User(username='test_user')
+        user.set_password('test123')
+        cls.db.session.add(user)
+
+        # Создаем тестовый фильм с русским названием
+        movie = cls.Movie(
+            title='Тестовый фильм',
+            year=2024,
+            director='Тестовый режиссер'
+        )
+        cls.db.session.add(movie)
+
+        cls.db.session.flush()
+
+        cls.movie_id = movie.id
 
     def test_russian_content_in_review(self):
         # Тест создания отзыва с русским текстом
@@ -387,53 +755,21 @@ class RussianAPITestCase(unittest.TestCase):
 
 
 # Простые тесты с временной базой данных
-class SimpleAPITests(unittest.TestCase):
+class SimpleAPITests(DatabaseTestCase):
     # Простые тесты с временной БД
 
-    def setUp(self):
-        # Создаем временную БД в памяти
-        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
-
-        from app import app, db
-        from models import User, Movie
-
-        self.app = app
-        self.db = db
-        self.User = User
-        self.Movie = Movie
-
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.db_path}'
-        self.app.config['WTF_CSRF_ENABLED'] = False
-        self.app.config['SECRET_KEY'] = 'test-secret-key'
-
-        self.client = self.app.test_client()
-
-        # Создаем таблицы и минимальные данные
-        with self.app.app_context():
-            self.db.create_all()
-
-            # Создаем один фильм для тестов
-            movie = self.Movie(
-                title='Simple Test Movie',
-                year=2024,
-                director='Test Director'
-            )
-            self.db.session.add(movie)
-            self.db.session.commit()
-
-            self.movie_id = movie.id
-
-    def tearDown(self):
-        with self.app.app_context():
-            self.db.session.remove()
-            self.db.drop_all()
-
-        os.close(self.db_fd)
-        try:
-            os.unlink(self.db_path)
-        except:
-            pass
+    @classmethod
+    def create_fixtures(cls):
+        # Создаем один фильм для тестов
+        movie = cls.Movie(
+            title='Simple Test Movie',
+            year=2024,
+            director='Test Director'
+        )
+        cls.db.session.add(movie)
+        cls.db.session.flush()
+
+        cls.movie_id = movie.id
 
     def test_api_endpoints_exist(self):
         # Тест что основные API endpoints существуют